@@ -1,25 +1,44 @@
 import os
+import gzip
+import asyncio
 import logging
-import re
-import json
 import functools
 
-from flask import Flask, request, make_response, jsonify
-from requests_toolbelt import MultipartDecoder
+import orjson
+from quart import Quart, Response, request, make_response
+from quart.json.provider import DefaultJSONProvider
 
-from lib import manager, util, usage
+from lib import manager, util, usage, upload
 
 logger = logging.getLogger("gluestick-api")
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
 
-app = Flask(__name__)
 
-@app.before_first_request
-def init():
-    # Check if usage stats are enabled
-    usage_stats = os.environ.get("GLUESTICK_USAGE_STATS", "DISABLE") == "ENABLE"
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Serializes JSON with orjson instead of the stdlib encoder
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+# Uploads are streamed to disk, don't cap them at Quart's default 16MB
+app.config["MAX_CONTENT_LENGTH"] = None
+
+# Form field carrying the uploaded file, the first file part is used when unset
+UPLOAD_FIELD = os.environ.get("GLUESTICK_UPLOAD_FIELD")
+# Responses smaller than this aren't worth compressing
+GZIP_MIN_SIZE = 500
 
-    if usage_stats:
+@app.before_serving
+async def init():
+    # Check if usage stats are enabled
+    if usage.is_enabled():
         logger.info("""
         Anonymous usage tracking statistics are enabled.
         If you'd like to disable this, please refer to the gluestick docs https://docs.gluestick.xyz
@@ -40,87 +59,111 @@ def init():
 #############
 def cors(func):
     @functools.wraps(func)
-    def wrapper(*args, **kwargs):
+    async def wrapper(*args, **kwargs):
         if request.method == "OPTIONS": # CORS preflight
-            return cors_preflight()
+            return await cors_preflight()
 
-        return func(*args, **kwargs)
+        return await func(*args, **kwargs)
     return wrapper
 
 
-def cors_preflight():
-    response = make_response()
+async def cors_preflight():
+    response = await make_response()
     response.headers.add("Access-Control-Allow-Origin", "*")
     response.headers.add('Access-Control-Allow-Headers', "*")
     response.headers.add('Access-Control-Allow-Methods', "*")
     return response
 
 
+def ojsonify(data):
+    # Encode straight to bytes, skipping the provider's str round-trip
+    body = orjson.dumps(data, default=app.json.default, option=orjson.OPT_NON_STR_KEYS)
+    return Response(body, mimetype="application/json")
+
+
 def corsify(data):
-    response = jsonify(data)
+    response = ojsonify(data)
     response.headers.add("Access-Control-Allow-Origin", "*")
     return response
 
 
+#############
+# GZIP      #
+#############
+@app.after_request
+async def compress(response):
+    """
+    Gzips responses of at least GZIP_MIN_SIZE bytes for clients accepting it
+    """
+    if "gzip" not in request.headers.get("Accept-Encoding", "") or "Content-Encoding" in response.headers:
+        return response
+
+    body = await response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+
+    # set_data updates the Content-Length
+    response.set_data(gzip.compress(body, compresslevel=4))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
 #############
 # FILES     #
 #############
-def _get_parts():
-    content = request.get_data()
+async def _receive_file(user):
+    """
+    Streams the uploaded file into the user's data dir, returns its filename
+    """
     content_type = request.headers['content-type']
     logger.info(f"Received ContentType Header ==> {content_type}")
 
-    decoder = MultipartDecoder(content, content_type)
-
-    files = []
-    for p in decoder.parts:
-        result = dict()
+    user_dir = manager.establish_user_dir(user)
 
-        result['content'] = p.content
-        content_type = p.headers.get(b'content-type')
-        if content_type is not None:
-            result['content-type'] = content_type.decode("utf-8")
+    if UPLOAD_FIELD is not None:
+        receiver = upload.FieldReceiver(content_type, user_dir, UPLOAD_FIELD)
+    else:
+        receiver = upload.FirstFileReceiver(content_type, user_dir)
 
-        content_disposition = p.headers.get(b'content-disposition')
-        if content_disposition is not None:
-            content_disposition = content_disposition.decode("utf-8")
-            m = re.search(r'filename=\"([^\"]*)', content_disposition)
-            result['content-disposition'] = content_disposition
-            if m and m.group(1):
-                result['filename'] = m.group(1)
+    try:
+        # Feed the parser as the body arrives, it is only buffered while the parser catches up
+        async for chunk in request.body:
+            await asyncio.to_thread(receiver.data_received, chunk)
 
-        files.append(result)
-
-    return files
+        return await asyncio.to_thread(receiver.finish)
+    except Exception:
+        await asyncio.to_thread(receiver.discard)
+        raise
 
 
 @app.route('/status', methods=['GET', 'OPTIONS'])
 @cors
-def status():
+async def status():
     usage.track("Status")
     return corsify({'code': 'success'})
 
 
 @app.route('/file/<user>/import', methods=['POST', 'OPTIONS'])
 @cors
-def do_import(user):
-    body = request.json
+async def do_import(user):
+    body = await request.get_json()
     filename = body.get("filename")
     usage.track("Import")
 
     # Do the import
-    manager.do_import(user, filename)
+    await asyncio.to_thread(manager.do_import, user, filename)
 
-    # Trigger webhook
-    util.trigger_hook(user, util.Lifecycle.DATA_EXPORTED)
+    # Trigger webhook, without holding up the response
+    app.add_background_task(util.trigger_hook, user, util.Lifecycle.DATA_EXPORTED)
 
     return corsify({'code': 'sucess'})
 
 
 @app.route('/file/<user>/map', methods=['POST', 'OPTIONS'])
 @cors
-def do_mapping(user):
-    body = request.json
+async def do_mapping(user):
+    body = await request.get_json()
     filename = body.get("filename")
     mapping = body.get("mapping")
     schema = body.get("schema")
@@ -129,21 +172,22 @@ def do_mapping(user):
     if mapping is None:
         return corsify({'code': 'error', 'message': 'No mapping Provided'}), 400
 
-    logger.debug(f"[do_mapping]: Received mapping={json.dumps(mapping)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[do_mapping]: Received mapping=%s", orjson.dumps(mapping).decode("utf-8"))
 
     # Generate the new file
-    data = manager.do_mapping(user, filename, mapping, schema)
+    data = await asyncio.to_thread(manager.do_mapping, user, filename, mapping, schema)
 
-    # Trigger webhook
-    util.trigger_hook(user, util.Lifecycle.MAPPING_COMPLETED)
+    # Trigger webhook, without holding up the response
+    app.add_background_task(util.trigger_hook, user, util.Lifecycle.MAPPING_COMPLETED)
 
     return corsify({'code': 'success', 'data': data})
 
 
 @app.route('/file/<user>/validate', methods=['POST', 'OPTIONS'])
 @cors
-def validate_mapping(user):
-    body = request.json
+async def validate_mapping(user):
+    body = await request.get_json()
     filename = body.get("filename")
     mapping = body.get("mapping")
     schema = body.get("schema")
@@ -152,41 +196,38 @@ def validate_mapping(user):
     if mapping is None:
         return corsify({'code': 'error', 'message': 'No mapping Provided'}), 400
 
-    logger.debug(f"[validate_mapping]: Received mapping={json.dumps(mapping)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[validate_mapping]: Received mapping=%s", orjson.dumps(mapping).decode("utf-8"))
 
     # Validate the mapping
-    data = manager.validate_mapping(user, filename, mapping, schema)
+    data = await asyncio.to_thread(manager.validate_mapping, user, filename, mapping, schema)
 
-    # Trigger webhook
-    util.trigger_hook(user, util.Lifecycle.MAPPING_VALIDATION)
+    # Trigger webhook, without holding up the response
+    app.add_background_task(util.trigger_hook, user, util.Lifecycle.MAPPING_VALIDATION)
 
     return corsify({'code': 'success', 'data': data})
 
 
 @app.route('/file/<user>/upload', methods=['POST', 'OPTIONS'])
 @cors
-def upload_file(user):
+async def upload_file(user):
     logger.debug(f"[upload_file]: parsing payload")
-    files = _get_parts()
-    usage.track("Upload")
+    try:
+        filename = await _receive_file(user)
+    except upload.IncompleteUploadError:
+        return corsify({'code': 'error', 'message': 'Incomplete file upload'}), 400
 
-    if files is None or len(files) == 0:
-        return {'code': 'error', 'message': 'No Schema Provided'}, 400
-
-    logger.debug(f"[upload_file]: received {len(files)} files")
+    usage.track("Upload")
 
-    # Currently restricted to one file
-    file = files[0]
-    filename = file.get('filename')
+    if filename is None:
+        return {'code': 'error', 'message': 'No file Provided'}, 400
 
-    # Save the file
-    logger.info(f"[upload_file]: Uploading {filename}")
-    manager.save_data(user, filename, file.get("content"))
+    logger.info(f"[upload_file]: Uploaded {filename}")
 
     # Return the column names, and first 5 rows
-    data = manager.parse_data(user, filename)
+    data = await asyncio.to_thread(manager.parse_data, user, filename)
 
-    # Trigger webhook
-    util.trigger_hook(user, util.Lifecycle.FILE_UPLOADED)
+    # Trigger webhook, without holding up the response
+    app.add_background_task(util.trigger_hook, user, util.Lifecycle.FILE_UPLOADED)
 
     return corsify({'code': 'success', 'data': data, 'filename': filename})
@@ -1,16 +1,79 @@
-import json
+import csv
+import functools
 import logging
 import os
+import re
 import shutil
 import subprocess
 import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
 from lib import util, exec
 
 logger = logging.getLogger("gluestick-api")
 
+# Target config read from the environment once, values are formatted per user.
+# Converts the environment key into config key format (GLUESTICK_TARGET_BUCKET -> bucket)
+_TARGET_CONFIG_TEMPLATE = [
+    (key[17:].lower(), value) for key, value in os.environ.items() if key.startswith("GLUESTICK_TARGET_")
+]
+
+
+# Bounded, validators come from client requests
+@functools.lru_cache(maxsize=256)
+def _compiled(pattern):
+    """
+    Returns the compiled validator pattern, compiling it only once
+    """
+    return re.compile(pattern)
+
+
+def _match(values, pattern):
+    """
+    Returns a boolean mask of the non-null string values matching pattern
+
+    Patterns run on PyArrow's RE2 engine, which differs from Python's re:
+    - \\d, \\w and \\s only match ASCII, so \\d+ doesn't match "١٢"
+    - $ only matches at the very end, not before a trailing newline
+    - POSIX classes like [[:alpha:]] are supported
+    Lookarounds and backreferences aren't supported by RE2 and fall back to re.
+    """
+    try:
+        # Runs on PyArrow's RE2 engine, anchored like re.match
+        matched = values.str.match(f"^(?:{pattern})", na=False)
+    except pa.ArrowInvalid:
+        # RE2 doesn't support lookarounds or backreferences, use Python's re for those
+        matched = values.astype(object).str.match(_compiled(pattern), na=False)
+
+    return values.notna() & matched
+
+
+def _read_csv_text(path, usecols=None):
+    """
+    Reads path into Arrow-backed columns, keeping every cell as the text that was uploaded
+    """
+    # Arrow would otherwise infer types, turning dates into timestamps or 007 into 7
+    if usecols is None:
+        with open(path, newline='', encoding="utf-8-sig") as f:
+            usecols = next(csv.reader(f), [])
+
+    convert_options = pacsv.ConvertOptions(
+        include_columns=usecols,
+        column_types={col: pa.string() for col in usecols},
+        strings_can_be_null=True
+    )
+
+    return pacsv.read_csv(path, convert_options=convert_options).to_pandas(types_mapper=pd.ArrowDtype)
+
+
+@functools.lru_cache(maxsize=1)
 def establish_dirs():
     """
     Establish any necessary directories
@@ -22,44 +85,52 @@ def establish_dirs():
     return data_dir
 
 
-def validate_mapping(user, filename, mapping, schema):
+@functools.lru_cache(maxsize=1024)
+def establish_user_dir(user):
     """
-    Checks if mapping is valid using the validator
+    Establish the data directory of user
     """
-    data_dir = establish_dirs()
-    from_path = f"{data_dir}/{user}/{filename}"
-    df = pd.read_csv(from_path)
+    user_dir = f"{establish_dirs()}/{user}"
+    os.makedirs(user_dir, exist_ok=True)
 
-    # Compute invalid mappings
-    invalid = {}
+    return user_dir
 
-    for field in schema['fields']:
-        regexp = field.get("validator")
-        if regexp is not None:
-            col = field['col']
-            # Compute against this
-            df_col = df[util.get_key(mapping, col)].astype("string")
-            valid = df_col.notna() & df_col.str.match(regexp)
-            counts = valid.value_counts()
-            percent_valid = counts.get(True, 0) / (counts.get(False, 0) + counts.get(True, 0))
-            invalid_data = df_col.loc[~valid]
-            invalid_rows = []
-
-            # Serialize first 5 invalid rows
-            for index, value in invalid_data.items():
-                if len(invalid_rows) > 5:
-                    break
-                if pd.isna(value):
-                    value = ''
-                invalid_rows.append(value)
-
-            # Tell them which were invalid
-            invalid[col] = {
-                'percent': "{:.2%}".format(percent_valid),
-                'rows': invalid_rows
-            }
-
-    return invalid
+
+def validate_mapping(user, filename, mapping, schema):
+    """
+    Checks if mapping is valid using the validator
+    """
+    from_path = f"{establish_user_dir(user)}/{filename}"
+
+    # Only parse the columns that have a validator
+    fields = [field for field in schema['fields'] if field.get("validator") is not None]
+    if len(fields) == 0:
+        return {}
+
+    usecols = list(dict.fromkeys(util.get_key(mapping, field['col']) for field in fields))
+    df = _read_csv_text(from_path, usecols)
+
+    def check(field):
+        col = field['col']
+        # Compute against this
+        df_col = df[util.get_key(mapping, col)].astype("string[pyarrow]")
+        valid = _match(df_col, field["validator"])
+
+        # Serialize first 5 invalid rows
+        return col, float(valid.mean()), df_col.loc[~valid].head(5).fillna('').astype(str).tolist()
+
+    # Arrow's regex kernels release the GIL, so columns are checked in parallel
+    with ThreadPoolExecutor(max_workers=min(8, len(fields))) as executor:
+        results = list(executor.map(check, fields))
+
+    # Tell them which were invalid
+    return {
+        col: {
+            'percent': "{:.2%}".format(percent_valid),
+            'rows': invalid_rows
+        }
+        for col, percent_valid, invalid_rows in results
+    }
 
 
 def do_import(user, filename):
@@ -72,8 +143,7 @@ def do_import(user, filename):
     if target is None:
         return
 
-    data_dir = establish_dirs()
-    user_dir = f"{data_dir}/{user}"
+    user_dir = establish_user_dir(user)
     file_path = f"{user_dir}/{filename}".replace(".csv", "-mod.csv")
 
     # Prepare output dir
@@ -85,23 +155,20 @@ def do_import(user, filename):
     output_format = os.environ.get("GLUESTICK_TARGET_FORMAT", "csv")
 
     if output_format == "csv":
-        # Just copy the file over
-        shutil.copyfile(file_path, f"{output_dir}/{filename}")
+        # Just link the file over, copy it when it's on another filesystem
+        output_path = f"{output_dir}/{filename}"
+        try:
+            os.link(file_path, output_path)
+        except OSError:
+            shutil.copyfile(file_path, output_path)
     elif output_format == "json":
-        df = pd.read_csv(file_path)
-        data = df.to_dict('records')
-        util.write_json_file(f"{output_dir}/{filename.replace('.csv', '.json')}", data)
+        _write_json_records(file_path, f"{output_dir}/{filename.replace('.csv', '.json')}")
 
     # Build the target config.json
-    config_keys = [x for x in os.environ.keys() if x.startswith("GLUESTICK_TARGET_")]
     target_config = {
         'input_path': output_dir
     }
-
-    for key in config_keys:
-        # Convert the environment key into config key format (GLUESTICK_TARGET_BUCKET -> bucket)
-        config_key = key[17:].lower()
-        target_config[config_key] = os.environ[key].format(user=user)
+    target_config.update((config_key, value.format(user=user)) for config_key, value in _TARGET_CONFIG_TEMPLATE)
 
     # Write the target config
     util.write_json_file(f"{user_dir}/config.json", target_config)
@@ -117,83 +184,83 @@ def do_import(user, filename):
         raise spe
 
 
+def _write_json_records(csv_path, json_path, batch_size=10000):
+    """
+    Writes the rows of csv_path to json_path as a JSON array of records
+    """
+    # Keep empty text cells as null
+    convert_options = pacsv.ConvertOptions(strings_can_be_null=True)
+    table = pacsv.read_csv(csv_path, convert_options=convert_options)
+
+    # Dates, times and timestamps are written back as the text they were read from
+    temporal = {field.name: pa.string() for field in table.schema if pa.types.is_temporal(field.type)}
+    if temporal:
+        convert_options = pacsv.ConvertOptions(strings_can_be_null=True, column_types=temporal)
+        table = pacsv.read_csv(csv_path, convert_options=convert_options)
+
+    with open(json_path, 'wb') as f:
+        f.write(b"[")
+        first = True
+
+        # Encode a batch at a time rather than building every record up front
+        for batch in table.to_batches(max_chunksize=batch_size):
+            if batch.num_rows == 0:
+                continue
+            if not first:
+                f.write(b",")
+            # Strip the brackets of the batch's own array
+            f.write(orjson.dumps(batch.to_pylist())[1:-1])
+            first = False
+
+        f.write(b"]")
+
+
 def do_mapping(user, filename, mapping, schema):
     """
     Update column names of filename according to mapping dict
     """
-    data_dir = establish_dirs()
-    from_path = f"{data_dir}/{user}/{filename}"
+    from_path = f"{establish_user_dir(user)}/{filename}"
     to_path = from_path.replace(".csv", "-mod.csv")
 
-    # Update column names
+    # Only parse the mapped columns, then rename them
     # TODO: Won't work for CSV files with different separator or XLS files
-    with open(from_path) as from_file, open(to_path, 'w') as to_file:
-        # Get old cols
-        cols = from_file.readline().rstrip().split(",")
-        # Update col names
-        new_cols = list(map(lambda x: mapping[x] if x in mapping else x, cols))
-        # Create new header
-        new_header = ",".join(new_cols) + '\n'
-        # Write new header
-        to_file.write(new_header)
-        # Save the rest of the file
-        shutil.copyfileobj(from_file, to_file)
-
-    # Read the updated file
-    df = pd.read_csv(to_path)
-
-    # Drop any unnecessary columns
-    # TODO: Is the best way of handling this?
-    if len(mapping) < len(cols):
-        # Get the required col names
-        required_cols = list(mapping.values())
-        # Only keep these
-        df = df[required_cols]
-
-    # Validation
+    df = _read_csv_text(from_path, list(mapping.keys()) or None)
+    df = df.rename(columns=mapping)
+
+    # Validation, AND every field's mask together and slice once
+    valid = np.ones(len(df), dtype=bool)
+
     for field in schema['fields']:
         regexp = field.get("validator")
         if regexp is not None:
             col = field['col']
-            valid = df[col].notna() & df[col].str.match(regexp)
+            valid &= _match(df[col].astype("string[pyarrow]"), regexp).to_numpy(dtype=bool, na_value=False)
 
-            # Only keep valid rows
-            df = df.loc[valid]
+    # Only keep valid rows
+    df = df.loc[valid]
 
-    # Write the new CSV
-    df.to_csv(to_path, index=False)
+    # Write the new CSV, replacing rather than overwriting it so an exported hardlink keeps its data
+    tmp_path = f"{to_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, to_path)
+    except Exception:
+        util.del_file(tmp_path)
+        raise
 
     # Return a preview
     return preview_df(to_path)
 
 
-def save_data(user, filename, content):
-    """
-    Save data to data_dir
-    """
-    data_dir = establish_dirs()
-    user_dir = f"{data_dir}/{user}"
-    os.makedirs(user_dir, exist_ok=True)
-
-    # Save the file
-    util.write_file(f"{user_dir}/{filename}", content)
-
-
 def parse_data(user, filename):
     """
     Returns the columns and first 5 rows as JSON
     """
-    data_dir = establish_dirs()
-
     # Read the first 5 rows of input data
-    df = pd.read_csv(f"{data_dir}/{user}/{filename}", nrows=5)
-    cols = list(df.columns)
-    data = {}
-
-    for col in cols:
-        data[col] = json.loads(df[col].to_json())
+    df = pd.read_csv(f"{establish_user_dir(user)}/{filename}", nrows=5)
 
-    return data
+    # Columns map row index to value, missing values are sent as null
+    return df.astype(object).where(df.notna(), None).to_dict()
 
 
 def preview_df(path):
@@ -203,14 +270,6 @@ def preview_df(path):
     # Read only the first 5 rows
     df = pd.read_csv(path, nrows=5)
     cols = list(df.columns)
-    rows = [cols]
-
-    for index, row in df.iterrows():
-        row_data = []
-
-        for col in cols:
-            row_data.append(row[col])
-
-        rows.append(row_data)
 
-    return rows
+    # Missing values are sent as null
+    return [cols] + df.astype(object).where(df.notna(), None).values.tolist()
@@ -0,0 +1,127 @@
+import os
+import uuid
+
+from multipart import MultipartError, MultipartSegment, PushMultipartParser, parse_options_header
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import FileTarget, ValueTarget
+
+from lib import util
+
+
+class IncompleteUploadError(ValueError):
+    """
+    Raised when the multipart payload ends before its closing delimiter
+    """
+
+
+class FieldReceiver:
+    """
+    Streams the file sent under a known form field into directory
+    """
+    def __init__(self, content_type, directory, field):
+        self._parser = StreamingFormDataParser(headers={'Content-Type': content_type})
+        self._directory = directory
+        # The parser doesn't check the payload is complete, so look out for its closing delimiter
+        _, options = parse_options_header(content_type)
+        self._delimiter = f"--{options['boundary']}--".encode("utf-8")
+        self._tail = b""
+        self._complete = False
+        # The filename may only arrive after the file, so it is written under a temporary name
+        self._path = f"{directory}/.upload-{uuid.uuid4().hex}"
+        self._file = FileTarget(self._path)
+        self._filename = ValueTarget()
+
+        self._parser.register(field, self._file)
+        self._parser.register('filename', self._filename)
+
+    def data_received(self, chunk):
+        self._parser.data_received(chunk)
+
+        if not self._complete:
+            # The delimiter may straddle two chunks, keep the end of the previous one around
+            size = len(self._delimiter)
+            self._complete = self._delimiter in self._tail + chunk[:size] or self._delimiter in chunk
+            self._tail = (self._tail + chunk)[1 - size:] if len(chunk) < size else chunk[1 - size:]
+
+    def finish(self):
+        """
+        Returns the filename of the received file, if any
+        """
+        if not self._complete:
+            self.discard()
+            raise IncompleteUploadError("Multipart payload ended before its closing delimiter")
+
+        # An explicit filename field takes precedence over the part's content-disposition
+        if self._filename.value:
+            filename = self._filename.value.decode("utf-8")
+        else:
+            filename = self._file.multipart_filename
+
+        if not filename or not os.path.exists(self._path):
+            self.discard()
+            return None
+
+        # The file is already on disk, just give it its final name
+        filename = os.path.basename(filename)
+        os.replace(self._path, f"{self._directory}/{filename}")
+
+        return filename
+
+    def discard(self):
+        util.del_file(self._path)
+
+
+class FirstFileReceiver:
+    """
+    Streams the first file of a multipart payload into directory, whatever its field name
+    """
+    def __init__(self, content_type, directory):
+        _, options = parse_options_header(content_type)
+        self._parser = PushMultipartParser(options['boundary'])
+        self._directory = directory
+        # Written under a temporary name, so a failed upload never replaces a previous file
+        self._path = f"{directory}/.upload-{uuid.uuid4().hex}"
+        self._file = None
+        self.filename = None
+
+    def data_received(self, chunk):
+        for result in self._parser.parse(chunk):
+            if isinstance(result, MultipartSegment):
+                # Start of a new part, only keep the first one carrying a file
+                if self.filename is None and result.filename:
+                    self.filename = os.path.basename(result.filename)
+                    self._file = open(self._path, 'wb')
+            elif result:
+                if self._file is not None:
+                    self._file.write(result)
+            elif self._file is not None:
+                # End of the file part
+                self._file.close()
+                self._file = None
+
+    def finish(self):
+        """
+        Returns the filename of the received file, if any
+        """
+        # An empty chunk signals the end of the payload
+        try:
+            self.data_received(b"")
+        except MultipartError as err:
+            raise IncompleteUploadError(str(err)) from err
+
+        if not self.filename:
+            self.discard()
+            return None
+
+        # The file is complete, give it its final name
+        os.replace(self._path, f"{self._directory}/{self.filename}")
+
+        return self.filename
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        # Don't leave a partial upload behind
+        util.del_file(self._path)
@@ -3,6 +3,7 @@ This tracks anonymized usage statistics of gluestick using Mixpanel.
 If you'd like to disable this, please refer to the gluestick docs https://docs.gluestick.xyz
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from mixpanel import Mixpanel
 from shortid import ShortId
@@ -11,15 +12,31 @@ mp = Mixpanel('abc')
 sid = ShortId()
 anon_id = sid.generate()
 
+# Whether usage stat collection is enabled, read once at startup
+_ENABLED = os.environ.get("GLUESTICK_USAGE_STATS", "DISABLE") == "ENABLE"
+
+# Events are sent in the background so requests don't wait on Mixpanel
+_POOL = ThreadPoolExecutor(max_workers=1)
+
+
+def is_enabled():
+    return _ENABLED
+
+
+def set_enabled(enabled):
+    """
+    Enables or disables usage stat collection
+    """
+    global _ENABLED
+    _ENABLED = enabled
+
+
 def track(event_name, event_data = {}):
     """
     Sends event to Mixpanel using anon_id
     """
-    # Check if usage stat collection is enabled
-    is_enabled = os.environ.get("GLUESTICK_USAGE_STATS", "DISABLE") == "ENABLE"
-    if not is_enabled:
+    if not _ENABLED:
         return
 
     # Send event to Mixpanel
-    mp.track(anon_id, event_name, event_data)
-
+    _POOL.submit(mp.track, anon_id, event_name, event_data)
@@ -3,6 +3,8 @@ import json
 import enum
 import shutil
 
+import httpx
+
 
 class Lifecycle(enum.Enum):
     FILE_UPLOADED = "FILE_UPLOADED"
@@ -24,7 +26,7 @@ def create_signature(webhook_secret, payload):
 
 
 # Invokes the environment configured webhook with specified payload
-def trigger_hook(user, status):
+async def trigger_hook(user, status):
     # Build the payload
     payload = json.dumps({'user': user, 'status': status.value}, separators=(',', ':'))
 
@@ -54,12 +56,15 @@ def trigger_hook(user, status):
     message = f"Invoke client's gluestick webhook with params [{json.dumps(params)}]\n"
 
     try:
-        # Send request
-        response = requests.post(
-            params.get('endpoint'),
-            data=params.get('data'),
-            headers=params.get('headers')
-        )
+        # Send request, without the signature header if there's no secret
+        headers = {k: v for k, v in params.get('headers').items() if v is not None}
+
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                params.get('endpoint'),
+                content=params.get('data'),
+                headers=headers
+            )
 
         status = response.status_code
         message += response.text
@@ -76,14 +81,6 @@ def write_json_file(filename, content):
         json.dump(content, f, indent=4)
 
 
-def write_file(filename, data):
-    fh = open(filename, "wb")
-    try:
-        fh.write(data)
-    finally:
-        fh.close()
-
-
 def get_key(d, val):
     for key, value in d.items():
          if val == value:
@@ -92,6 +89,11 @@ def get_key(d, val):
     return None
 
 
+def del_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
 def del_exists(path):
     if os.path.exists(path):
         shutil.rmtree(path)